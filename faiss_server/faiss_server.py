@@ -2,16 +2,27 @@ from flask import Flask, request, jsonify, send_file
 import faiss
 import numpy as np
 import openai
+from openai import AsyncOpenAI
+import asyncio
 import os
 import pickle
+import pickletools
 import threading
+import queue
+from concurrent.futures import ThreadPoolExecutor
 import time
 import json
+import sqlite3
 from flask_cors import CORS
 from dotenv import load_dotenv
 from datetime import datetime
 import zipfile
+import io
 import tempfile
+import hashlib
+import base64
+from collections import OrderedDict, Counter
+from contextlib import contextmanager
 
 load_dotenv(dotenv_path="../.env")
 
@@ -19,30 +30,167 @@ app = Flask(__name__)
 CORS(app)
 
 openai.api_key = os.getenv("VITE_OPENAI_API_KEY")
+# let FAISS parallelize search across all cores
+faiss.omp_set_num_threads(os.cpu_count() or 1)
 embedding_dim = 1536
-INDEX_PATH = "faiss.index"
+EMBEDDING_MODEL = "text-embedding-3-small"
+EMBED_CHUNK_SIZE = 256
+EMBED_MAX_CONCURRENCY = 8
+EMBED_QUEUE_WAIT_SECONDS = 0.02
+EMBED_REQUEST_TIMEOUT = 30
+# room for the SDK's retries plus time queued behind other batches
+EMBED_WAIT_TIMEOUT = 120
+HNSW_M = 32
+HNSW_EF_CONSTRUCTION = 80
+HNSW_EF_SEARCH = 64
+# vectors are L2-normalized and searched by inner product; the on-disk file
+# name is versioned so an older L2 index is never loaded into the IP setup.
+# Exports keep the public name faiss.index: a restored one goes through the
+# legacy migration, which is harmless since normalize_L2 is idempotent
+INDEX_PATH = "faiss_ip.index"
+LEGACY_INDEX_PATH = "faiss.index"
 META_PATH = "metadata.pkl"
+META_DB_PATH = "metadata.db"
 EXPORT_DIR = "exports"
+EMBEDDING_CACHE_DIR = "embedding_cache"
+EMBEDDING_CACHE_SIZE = 10000
 
-# create export directory
+# create export and embedding cache directories
 os.makedirs(EXPORT_DIR, exist_ok=True)
+os.makedirs(EMBEDDING_CACHE_DIR, exist_ok=True)
+
+# mkstemp creates 0600 files; swapped-in files should get the usual umask mode
+UMASK = os.umask(0)
+os.umask(UMASK)
+
+@contextmanager
+def atomic_replace(path):
+    """yield a temporary path next to path, swapped in once the block succeeds"""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".", suffix=".tmp")
+    os.close(fd)
+    try:
+        yield tmp_path
+        os.chmod(tmp_path, 0o666 & ~UMASK)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+# ========== INDEX LOCK ==========
+class IndexLock:
+    """readers-writer lock: concurrent searches, exclusive adds"""
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._readers = 0
+        self._writing = False
+        self._writers_waiting = 0
+
+    @contextmanager
+    def read(self):
+        with self._cond:
+            # waiting writers go first so a steady query load can't starve inserts
+            while self._writing or self._writers_waiting:
+                self._cond.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._readers -= 1
+                if not self._readers:
+                    self._cond.notify_all()
+
+    @contextmanager
+    def write(self):
+        with self._cond:
+            self._writers_waiting += 1
+            while self._writing or self._readers:
+                self._cond.wait()
+            self._writers_waiting -= 1
+            self._writing = True
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._writing = False
+                self._cond.notify_all()
+
+# guards index, metadata_store and formatted_texts; take it before batch_pool_lock
+index_lock = IndexLock()
+
+# set when the in-memory index has vectors not yet written to INDEX_PATH
+INDEX_DIRTY = False
+
+def create_index():
+    # HNSW graph gives sub-linear search with near-exact recall
+    new_index = faiss.IndexHNSWFlat(embedding_dim, HNSW_M, faiss.METRIC_INNER_PRODUCT)
+    new_index.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+    new_index.hnsw.efSearch = HNSW_EF_SEARCH
+    return new_index
 
 # ========== LOAD INDEX & METADATA IF EXISTS ==========
 if os.path.exists(INDEX_PATH):
     index = faiss.read_index(INDEX_PATH)
     print("[FAISS] Loaded index from disk.")
 else:
-    index = faiss.IndexFlatL2(embedding_dim)
-    print("[FAISS] Created new index.")
+    index = create_index()
+    print("[FAISS] Created new HNSW index.")
+    if os.path.exists(LEGACY_INDEX_PATH):
+        # the raw vectors are kept in the legacy index, so migrate without re-embedding
+        legacy_index = faiss.read_index(LEGACY_INDEX_PATH)
+        if legacy_index.ntotal:
+            legacy_vectors = legacy_index.reconstruct_n(0, legacy_index.ntotal)
+            faiss.normalize_L2(legacy_vectors)
+            index.add(legacy_vectors)
+            INDEX_DIRTY = True
+        print(f"[FAISS] Migrated {legacy_index.ntotal} vectors from legacy L2 index {LEGACY_INDEX_PATH}.")
+
+if isinstance(index, faiss.IndexHNSW):
+    index.hnsw.efSearch = HNSW_EF_SEARCH
 
-if os.path.exists(META_PATH):
+# metadata rows are persisted to SQLite as they are inserted; rowid order
+# matches the FAISS row order
+meta_db = sqlite3.connect(META_DB_PATH, check_same_thread=False)
+meta_db.execute("PRAGMA journal_mode=WAL")
+meta_db.execute("CREATE TABLE IF NOT EXISTS eq(element TEXT PRIMARY KEY, json TEXT)")
+meta_db_lock = threading.Lock()
+
+def save_metadata_rows(equipment):
+    """append equipment rows to the metadata database, all or nothing"""
+    with meta_db_lock, meta_db:
+        inserted = meta_db.executemany(
+            "INSERT OR IGNORE INTO eq VALUES(?, ?)",
+            [(str(e.get("element")), json.dumps(e, ensure_ascii=False)) for e in equipment]
+        ).rowcount
+        # a skipped row would shift every later rowid against the FAISS rows,
+        # so roll the whole batch back instead
+        if inserted != len(equipment):
+            raise RuntimeError(
+                f"Only {inserted} of {len(equipment)} metadata rows were new; duplicate element ids"
+            )
+
+def delete_metadata_rows(element_ids):
+    """remove rows written by an insert that could not be completed"""
+    with meta_db_lock, meta_db:
+        meta_db.executemany("DELETE FROM eq WHERE element = ?", [(eid,) for eid in element_ids])
+
+metadata_store = [json.loads(row[0]) for row in meta_db.execute("SELECT json FROM eq ORDER BY rowid")]
+if metadata_store:
+    print("[FAISS] Loaded metadata from database.")
+elif os.path.exists(META_PATH):
     with open(META_PATH, "rb") as f:
         metadata_store = pickle.load(f)
-    print("[FAISS] Loaded metadata from disk.")
+    try:
+        save_metadata_rows(metadata_store)
+    except RuntimeError as e:
+        raise RuntimeError(f"Refusing to migrate {META_PATH}: {e}") from e
+    print(f"[FAISS] Migrated metadata from {META_PATH} to {META_DB_PATH}.")
 else:
-    metadata_store = []
     print("[FAISS] Created new metadata store.")
 
+EXISTING_IDS = {str(m.get("element")) for m in metadata_store}
+
 def format_equipment_text(e):
     return f"""
     Equipment {e.get('name')} (element ID {e.get('element')}) is part of the {e.get('system')}.
@@ -52,105 +200,334 @@ def format_equipment_text(e):
     Inspection includes: {', '.join(e.get('inspection_requirements', []))}.
     """
 
+# format_equipment_text output per metadata row, kept outside the metadata itself
+formatted_texts = [format_equipment_text(e) for e in metadata_store]
+
+# ========== EMBEDDING CACHE ==========
+embedding_cache = OrderedDict()
+embedding_cache_lock = threading.Lock()
+
+def embedding_cache_key(text):
+    return hashlib.sha256((EMBEDDING_MODEL + "\0" + text).encode("utf-8")).hexdigest()
+
+def load_cached_embedding(key):
+    """look up an embedding in memory, then on disk"""
+    with embedding_cache_lock:
+        if key in embedding_cache:
+            embedding_cache.move_to_end(key)
+            return embedding_cache[key]
+
+    path = os.path.join(EMBEDDING_CACHE_DIR, f"{key}.npy")
+    if not os.path.exists(path):
+        return None
+    try:
+        vector = np.load(path)
+    except Exception as e:
+        print(f"[WARNING] Failed to read cached embedding {key}: {e}")
+        return None
+    remember_embedding(key, vector)
+    return vector
+
+def remember_embedding(key, vector):
+    """keep an embedding in the bounded in-memory cache"""
+    with embedding_cache_lock:
+        embedding_cache[key] = vector
+        embedding_cache.move_to_end(key)
+        while len(embedding_cache) > EMBEDDING_CACHE_SIZE:
+            embedding_cache.popitem(last=False)
+
+def store_cached_embedding(key, vector):
+    remember_embedding(key, vector)
+    try:
+        with atomic_replace(os.path.join(EMBEDDING_CACHE_DIR, f"{key}.npy")) as tmp_path:
+            with open(tmp_path, "wb") as f:
+                np.save(f, vector)
+    except Exception as e:
+        print(f"[WARNING] Failed to write cached embedding {key}: {e}")
+
+def decode_embedding(embedding):
+    """decode a base64 embedding straight into float32, skipping JSON float parsing"""
+    return np.frombuffer(base64.b64decode(embedding), dtype=np.float32)
+
+async def embed_texts_async(texts):
+    """embed texts in fixed-size chunks, requested concurrently"""
+    # group similar lengths into the same chunk, restore the order afterwards
+    by_length = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+    chunks = [by_length[i:i + EMBED_CHUNK_SIZE] for i in range(0, len(by_length), EMBED_CHUNK_SIZE)]
+    semaphore = asyncio.Semaphore(EMBED_MAX_CONCURRENCY)
+
+    async with AsyncOpenAI(api_key=openai.api_key) as aclient:
+        async def embed_chunk(chunk):
+            async with semaphore:
+                return await aclient.embeddings.create(
+                    input=[texts[i] for i in chunk],
+                    model=EMBEDDING_MODEL,
+                    encoding_format="base64",
+                    timeout=EMBED_REQUEST_TIMEOUT
+                )
+
+        responses = await asyncio.gather(*[embed_chunk(c) for c in chunks])
+
+    vectors = np.empty((len(texts), embedding_dim), dtype=np.float32)
+    for chunk, response in zip(chunks, responses):
+        for i, item in zip(chunk, response.data):
+            vectors[i] = decode_embedding(item.embedding)
+    return vectors
+
+# ========== EMBEDDING REQUEST QUEUE ==========
+embedding_queue = queue.Queue()
+# flushed batches run here so one slow request doesn't hold up the next batch
+embedding_executor = ThreadPoolExecutor(max_workers=EMBED_MAX_CONCURRENCY, thread_name_prefix="embed")
+
+def flush_embedding_batch(items):
+    """embed one batch of queued texts and wake their callers"""
+    try:
+        response = openai.embeddings.create(
+            input=[text for text, _, _ in items],
+            model=EMBEDDING_MODEL,
+            encoding_format="base64",
+            timeout=EMBED_REQUEST_TIMEOUT
+        )
+        for (_, _, slot), item in zip(items, response.data):
+            slot[0] = decode_embedding(item.embedding)
+    except Exception as e:
+        print(f"[ERROR] Batched embedding request failed: {e}")
+        for _, _, slot in items:
+            slot[0] = e
+    for _, done, _ in items:
+        done.set()
+
+def embedding_batcher():
+    """flush queued texts every EMBED_QUEUE_WAIT_SECONDS or EMBED_CHUNK_SIZE items"""
+    while True:
+        items = [embedding_queue.get()]
+        deadline = time.time() + EMBED_QUEUE_WAIT_SECONDS
+        while len(items) < EMBED_CHUNK_SIZE:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                items.append(embedding_queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+
+        embedding_executor.submit(flush_embedding_batch, items)
+
+threading.Thread(target=embedding_batcher, daemon=True).start()
+
+def embed_texts(texts):
+    """embed texts; small requests share API calls with other concurrent clients"""
+    if len(texts) >= EMBED_CHUNK_SIZE:
+        return asyncio.run(embed_texts_async(texts))
+
+    pending = [(text, threading.Event(), [None]) for text in texts]
+    for item in pending:
+        embedding_queue.put(item)
+
+    vectors = np.empty((len(texts), embedding_dim), dtype=np.float32)
+    for i, (_, done, slot) in enumerate(pending):
+        if not done.wait(timeout=EMBED_WAIT_TIMEOUT):
+            raise TimeoutError(f"Embedding request did not complete within {EMBED_WAIT_TIMEOUT}s")
+        if isinstance(slot[0], Exception):
+            raise slot[0]
+        vectors[i] = slot[0]
+    return vectors
+
 def get_embedding_batch(texts):
-    response = openai.embeddings.create(
-        input=texts,
-        model="text-embedding-3-small"
-    )
-    return [np.array(item.embedding, dtype=np.float32) for item in response.data]
+    """embed texts into an (N, embedding_dim) float32 array, only sending unique cache misses to OpenAI"""
+    unique = {}
+    order = [unique.setdefault(t, len(unique)) for t in texts]
+    unique_texts = list(unique)
+
+    keys = [embedding_cache_key(t) for t in unique_texts]
+    vectors = np.empty((len(unique_texts), embedding_dim), dtype=np.float32)
+    miss_idx = []
+    for i, key in enumerate(keys):
+        cached = load_cached_embedding(key)
+        if cached is None:
+            miss_idx.append(i)
+        else:
+            vectors[i] = cached
+
+    if miss_idx:
+        miss_vectors = embed_texts([unique_texts[i] for i in miss_idx])
+        vectors[miss_idx] = miss_vectors
+        for i, vector in zip(miss_idx, miss_vectors):
+            store_cached_embedding(keys[i], vector.copy())
+        print(f"[EMBED] {len(texts)} texts, {len(unique_texts)} unique, {len(miss_idx)} requested")
+
+    if len(unique_texts) == len(texts):
+        return vectors
+    return vectors[order]
+
+# ========== REBUILD INDEX FROM METADATA ==========
+# vectors without metadata can't be told apart from the rest, so start over
+if index.ntotal > len(metadata_store):
+    print(f"[FAISS] Index has {index.ntotal} vectors but only {len(metadata_store)} metadata rows, rebuilding it")
+    index = create_index()
+
+# metadata is committed on insert but the index only on save, so after a
+# crash (or a fresh index) the tail of metadata_store may be missing from it
+if index.ntotal < len(metadata_store):
+    missing = len(metadata_store) - index.ntotal
+    print(f"[FAISS] Index is missing {missing} items, re-embedding them from metadata")
+    rebuild_vectors = get_embedding_batch(formatted_texts[index.ntotal:])
+    faiss.normalize_L2(rebuild_vectors)
+    index.add(rebuild_vectors)
+    INDEX_DIRTY = True
+
+def search_index(query_vectors, k):
+    """search an (N, embedding_dim) query array, returning valid metadata rows per query"""
+    k = min(int(k), index.ntotal)
+    if k <= 0:
+        return [np.empty(0, dtype=np.int64) for _ in range(len(query_vectors))]
+    
+    faiss.normalize_L2(query_vectors)
+    # searches may run together, but not while another thread adds to the index
+    with index_lock.read():
+        D, I = index.search(query_vectors, k)
+        total = len(metadata_store)
+    # FAISS pads missing neighbours with -1
+    return [row[(row >= 0) & (row < total)] for row in I]
 
 # ========== SIMPLIFIED GLOBAL BATCH POOL ==========
+POOL_IDLE_SECONDS = 30
+
 batch_pool = []
-batch_pool_lock = threading.Lock()
+# reentrant so save_and_clear_pool can run while pool_monitor holds it
+batch_pool_lock = threading.RLock()
+pool_cv = threading.Condition(batch_pool_lock)
 last_append_time = [0]
 
+# bumped on every insert so unchanged exports can be served from disk
+EXPORT_VERSION = 0
+LAST_EXPORT_VERSION = -1
+LAST_JSON_EXPORT_VERSION = -1
+EXPORT_EPOCH = int(time.time())
+
+def snapshot_store():
+    """copy metadata and serialize the index under one lock so exported rows line up"""
+    with index_lock.read():
+        return list(metadata_store), faiss.serialize_index(index), index.ntotal
+
+def write_complete_database(f, items, index_size):
+    """stream complete database json to a text file, one equipment row at a time"""
+    equipment_by_system = Counter()
+    equipment_by_category = Counter()
+    for item in items:
+        equipment_by_system[item.get('system', 'Unknown')] += 1
+        equipment_by_category[item.get('subcategory', 'Unknown')] += 1
+    
+    header = {
+        "export_time": datetime.now().isoformat(),
+        "database_version": "1.0",
+        "total_equipment": len(items),
+        "faiss_index_size": index_size,
+        "statistics": {
+            "equipment_by_system": equipment_by_system,
+            "equipment_by_category": equipment_by_category,
+            "data_consistency": index_size == len(items)
+        }
+    }
+    
+    f.write('{"metadata":')
+    f.write(json.dumps(header, separators=(",", ":"), ensure_ascii=False))
+    f.write(',"equipment_database":[')
+    for i, item in enumerate(items):
+        if i:
+            f.write(",")
+        f.write(json.dumps(item, separators=(",", ":"), ensure_ascii=False))
+    f.write("]}")
+
 def save_complete_database():
-    """save complete database to json"""
+    """save complete database to json, returning its path and the export version it holds"""
+    global LAST_JSON_EXPORT_VERSION
     filename = "complete_database.json"
     filepath = os.path.join(EXPORT_DIR, filename)
+    version = EXPORT_VERSION
+    
+    if version == LAST_JSON_EXPORT_VERSION and os.path.exists(filepath):
+        print(f"[EXPORT] Metadata unchanged, reusing {filename}")
+        return filepath, version
     
     try:
         os.makedirs(EXPORT_DIR, exist_ok=True)
         print(f"[EXPORT] Creating database JSON at: {filepath}")
         
-        equipment_by_system = {}
-        equipment_by_category = {}
-        
-        for item in metadata_store:
-            system = item.get('system', 'Unknown')
-            category = item.get('subcategory', 'Unknown')
-            
-            equipment_by_system[system] = equipment_by_system.get(system, 0) + 1
-            equipment_by_category[category] = equipment_by_category.get(category, 0) + 1
-        
-        complete_data = {
-            "metadata": {
-                "export_time": datetime.now().isoformat(),
-                "database_version": "1.0",
-                "total_equipment": len(metadata_store),
-                "faiss_index_size": index.ntotal,
-                "statistics": {
-                    "equipment_by_system": equipment_by_system,
-                    "equipment_by_category": equipment_by_category,
-                    "data_consistency": index.ntotal == len(metadata_store)
-                }
-            },
-            "equipment_database": metadata_store
-        }
+        with index_lock.read():
+            items = list(metadata_store)
+            index_size = index.ntotal
         
-        with open(filepath, "w", encoding='utf-8') as f:
-            json.dump(complete_data, f, indent=2, ensure_ascii=False)
+        with atomic_replace(filepath) as tmp_path:
+            with open(tmp_path, "w", encoding='utf-8') as f:
+                write_complete_database(f, items, index_size)
         
-        print(f"[EXPORT] Complete database saved as {filename} ({len(metadata_store)} items)")
-        return filepath
+        LAST_JSON_EXPORT_VERSION = version
+        print(f"[EXPORT] Complete database saved as {filename} ({len(items)} items)")
+        return filepath, version
         
     except Exception as e:
         print(f"[ERROR] Failed to save complete database: {e}")
         raise
 
 def create_three_file_export():
-    """create a zip file with three core files"""
+    """create a zip file with three core files, returning its path and the export version it holds"""
+    global LAST_EXPORT_VERSION
     zip_filename = "three_file_export.zip"
     zip_filepath = os.path.join(EXPORT_DIR, zip_filename)
+    version = EXPORT_VERSION
+    
+    if version == LAST_EXPORT_VERSION and os.path.exists(zip_filepath):
+        print(f"[EXPORT] Metadata unchanged, reusing {zip_filename}")
+        return zip_filepath, version
     
     try:
         os.makedirs(EXPORT_DIR, exist_ok=True)
         print(f"[EXPORT] Creating ZIP at: {zip_filepath}")
         
-        with zipfile.ZipFile(zip_filepath, 'w', zipfile.ZIP_DEFLATED) as zipf:
-            # 1. complete_database.json
+        # all three files come from the same snapshot so their rows match
+        items, index_data, index_size = snapshot_store()
+        
+        with atomic_replace(zip_filepath) as tmp_path, \
+                zipfile.ZipFile(tmp_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
+            # 1. complete_database.json, streamed straight into the archive
             print("[EXPORT] Creating database JSON...")
-            db_json_path = save_complete_database()
-            zipf.write(db_json_path, "complete_database.json")
+            with zipf.open("complete_database.json", "w") as raw, \
+                    io.TextIOWrapper(raw, encoding="utf-8") as f:
+                write_complete_database(f, items, index_size)
             print(f"[EXPORT] Added complete_database.json to ZIP")
             
-            # 2. faiss.index
-            if os.path.exists(INDEX_PATH):
-                zipf.write(INDEX_PATH, "faiss.index")
-                print(f"[EXPORT] Added faiss.index to ZIP")
-            else:
-                print(f"[WARNING] FAISS index file not found")
+            # 2. faiss.index, raw float32 vectors barely deflate so store as-is
+            zipf.writestr("faiss.index", index_data.tobytes(), compress_type=zipfile.ZIP_STORED)
+            print(f"[EXPORT] Added faiss.index to ZIP")
             
             # 3. metadata.pkl
-            if os.path.exists(META_PATH):
-                zipf.write(META_PATH, "metadata.pkl")
-                print(f"[EXPORT] Added metadata.pkl to ZIP")
-            else:
-                print(f"[WARNING] Metadata file not found")
-        
-        print(f"[EXPORT] Three-file export created: {zip_filename}")
-        return zip_filepath
+            zipf.writestr("metadata.pkl", pickle_metadata(items))
+            print(f"[EXPORT] Added metadata.pkl to ZIP")
         
-    except Exception as e:
-        print(f"[ERROR] Failed to create three-file export: {e}")
-        raise
+        LAST_EXPORT_VERSION = version
         print(f"[EXPORT] Three-file export created: {zip_filename}")
-        return zip_filepath
+        return zip_filepath, version
         
     except Exception as e:
         print(f"[ERROR] Failed to create three-file export: {e}")
         raise
 
+def pickle_metadata(items):
+    # only pickled on demand, so the extra optimize pass is cheap to pay here
+    return pickletools.optimize(pickle.dumps(items, protocol=5))
+
+def save_metadata_pickle(items=None):
+    """write metadata rows (default: current metadata_store) to metadata.pkl"""
+    if items is None:
+        with index_lock.read():
+            items = list(metadata_store)
+    data = pickle_metadata(items)
+    with atomic_replace(META_PATH) as tmp_path:
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+    return META_PATH
+
 def save_and_clear_pool():
     """save pool data and add to main storage"""
     with batch_pool_lock:
@@ -159,25 +536,55 @@ def save_and_clear_pool():
             batch_pool.clear()
 
 def pool_monitor():
-    """monitor batch pool"""
-    while True:
-        time.sleep(10)
-        with batch_pool_lock:
-            if batch_pool and (time.time() - last_append_time[0] > 30):
-                save_and_clear_pool()
+    """monitor batch pool, waking only on inserts or when the idle window ends"""
+    with pool_cv:
+        while True:
+            if not batch_pool:
+                pool_cv.wait()
+                continue
+            remaining = POOL_IDLE_SECONDS - (time.time() - last_append_time[0])
+            if remaining > 0:
+                pool_cv.wait(timeout=remaining)
+                continue
+            save_and_clear_pool()
 
 threading.Thread(target=pool_monitor, daemon=True).start()
 
 # ========== AUTO SAVE THREAD ==========
+# held from serialize to os.replace so an older snapshot can never be
+# written over a newer one; taken before index_lock
+index_save_lock = threading.Lock()
+
+def write_index_data(index_data):
+    """write a serialized index through a temporary file so readers never see a partial file"""
+    with atomic_replace(INDEX_PATH) as tmp_path:
+        index_data.tofile(tmp_path)
+
+def save_index():
+    """write the FAISS index if it may have changed since the last save"""
+    global INDEX_DIRTY
+    with index_save_lock:
+        # snapshot under the read lock so inserts are only blocked for the in-memory copy
+        with index_lock.read():
+            with batch_pool_lock:
+                INDEX_DIRTY = False
+            data = faiss.serialize_index(index)
+        try:
+            write_index_data(data)
+        except Exception:
+            with batch_pool_lock:
+                INDEX_DIRTY = True
+            raise
+
 def periodic_save():
-    """periodically save FAISS index and metadata"""
+    """periodically save FAISS index when it changed (metadata is persisted on insert)"""
     while True:
         time.sleep(60) 
+        if not INDEX_DIRTY:
+            continue
         try:
-            faiss.write_index(index, INDEX_PATH)
-            with open(META_PATH, "wb") as f:
-                pickle.dump(metadata_store, f)
-            print("[FAISS] Auto-saved index and metadata")
+            save_index()
+            print("[FAISS] Auto-saved index")
         except Exception as e:
             print(f"[ERROR] Auto-save failed: {e}")
 
@@ -187,6 +594,7 @@ threading.Thread(target=periodic_save, daemon=True).start()
 
 @app.route("/insert_json_batch", methods=["POST"])
 def insert_json_batch():
+    global EXPORT_VERSION, INDEX_DIRTY
     equipment_list = request.json
     
     unique_equipment = {}
@@ -194,21 +602,42 @@ def insert_json_batch():
         element_id = str(e.get("element"))
         unique_equipment[element_id] = e
     
-    existing_ids = set(str(item.get("element")) for item in metadata_store)
-    new_equipment = [e for eid, e in unique_equipment.items() if eid not in existing_ids]
+    # reserve the new ids up front so concurrent requests don't insert them twice
+    with batch_pool_lock:
+        new_ids = [eid for eid in unique_equipment if eid not in EXISTING_IDS]
+        EXISTING_IDS.update(new_ids)
+    new_equipment = [unique_equipment[eid] for eid in new_ids]
     
     if not new_equipment:
         return jsonify({"status": "duplicate", "message": "All elements already exist.", "inserted": 0}), 409
     
-    texts = [format_equipment_text(e) for e in new_equipment]
-    vectors = get_embedding_batch(texts)
-    faiss_vectors = np.stack(vectors)
-    index.add(faiss_vectors)
-    metadata_store.extend(new_equipment)
+    try:
+        texts = [format_equipment_text(e) for e in new_equipment]
+        vectors = get_embedding_batch(texts)
+        faiss.normalize_L2(vectors)
+        
+        # FAISS rows, metadata_store and SQLite rowids must stay in the same order;
+        # SQLite goes first so a failed commit leaves the index untouched
+        with index_lock.write():
+            save_metadata_rows(new_equipment)
+            try:
+                index.add(vectors)
+            except Exception:
+                delete_metadata_rows(new_ids)
+                raise
+            metadata_store.extend(new_equipment)
+            formatted_texts.extend(texts)
+    except Exception:
+        with batch_pool_lock:
+            EXISTING_IDS.difference_update(new_ids)
+        raise
     
     with batch_pool_lock:
         batch_pool.extend(new_equipment)
         last_append_time[0] = time.time()
+        EXPORT_VERSION += 1
+        INDEX_DIRTY = True
+        pool_cv.notify()
     
     return jsonify({
         "status": "ok", 
@@ -226,7 +655,7 @@ def export_three_files():
         if len(metadata_store) == 0:
             return jsonify({"error": "No data to export. Database is empty."}), 400
         
-        zip_filepath = create_three_file_export()
+        zip_filepath, version = create_three_file_export()
         
         if not os.path.exists(zip_filepath):
             return jsonify({"error": f"Export file was not created successfully"}), 500
@@ -236,7 +665,8 @@ def export_three_files():
             zip_filepath, 
             as_attachment=True, 
             download_name=os.path.basename(zip_filepath),
-            mimetype='application/zip'
+            mimetype='application/zip',
+            etag=f"{EXPORT_EPOCH}-{version}"
         )
     except Exception as e:
         print(f"[ERROR] Export failed: {e}")
@@ -251,7 +681,7 @@ def export_database_json():
         if len(metadata_store) == 0:
             return jsonify({"error": "No data to export. Database is empty."}), 400
         
-        filepath = save_complete_database()
+        filepath, version = save_complete_database()
         
         if not os.path.exists(filepath):
             return jsonify({"error": "Database JSON file was not created successfully"}), 500
@@ -261,7 +691,8 @@ def export_database_json():
             filepath, 
             as_attachment=True, 
             download_name="complete_database.json",
-            mimetype='application/json'
+            mimetype='application/json',
+            etag=f"{EXPORT_EPOCH}-{version}"
         )
     except Exception as e:
         print(f"[ERROR] Database JSON export failed: {e}")
@@ -273,12 +704,13 @@ def export_faiss_index():
     try:
         print("[EXPORT] Starting FAISS index export...")
         
-        if not os.path.exists(INDEX_PATH):
-            return jsonify({"error": "FAISS index file not found. Try saving data first."}), 404
-        
         if index.ntotal == 0:
             return jsonify({"error": "FAISS index is empty. No vectors to export."}), 400
         
+        # don't hand out an index that lags behind the inserted metadata
+        if INDEX_DIRTY or not os.path.exists(INDEX_PATH):
+            save_index()
+        
         print(f"[EXPORT] Sending FAISS index with {index.ntotal} vectors")
         return send_file(
             INDEX_PATH, 
@@ -296,15 +728,14 @@ def export_metadata_pkl():
     try:
         print("[EXPORT] Starting metadata pickle export...")
         
-        if not os.path.exists(META_PATH):
-            return jsonify({"error": "Metadata pickle file not found. Try saving data first."}), 404
-        
         if len(metadata_store) == 0:
             return jsonify({"error": "Metadata store is empty. No data to export."}), 400
         
+        meta_path = save_metadata_pickle()
+        
         print(f"[EXPORT] Sending metadata with {len(metadata_store)} items")
         return send_file(
-            META_PATH, 
+            meta_path, 
             as_attachment=True, 
             download_name="metadata.pkl",
             mimetype='application/octet-stream'
@@ -317,16 +748,16 @@ def export_metadata_pkl():
 def save_now():
     """save all data immediately"""
     try:
-        faiss.write_index(index, INDEX_PATH)
-        
-        with open(META_PATH, "wb") as f:
-            pickle.dump(metadata_store, f)
+        with index_save_lock:
+            items, index_data, index_size = snapshot_store()
+            write_index_data(index_data)
+        save_metadata_pickle(items)
         
         return jsonify({
             "status": "ok",
             "message": "All data saved successfully",
-            "faiss_vectors": index.ntotal,
-            "metadata_items": len(metadata_store)
+            "faiss_vectors": index_size,
+            "metadata_items": len(items)
         })
     except Exception as e:
         return jsonify({"error": str(e)}), 500
@@ -343,7 +774,8 @@ def get_status():
             "data_consistency": index.ntotal == len(metadata_store),
             "files_exist": {
                 "faiss_index": os.path.exists(INDEX_PATH),
-                "metadata_pkl": os.path.exists(META_PATH)
+                "metadata_pkl": os.path.exists(META_PATH),
+                "metadata_db": os.path.exists(META_DB_PATH)
             }
         })
     except Exception as e:
@@ -356,14 +788,29 @@ def query_equipment():
         q = request.json.get("query")
         k = request.json.get("top_k", 50)
         
-        response = openai.embeddings.create(
-            input=[q],
-            model="text-embedding-3-small"
-        )
-        query_vector = np.array(response.data[0].embedding, dtype=np.float32)
+        query_vector = get_embedding_batch([q])[0]
+        ids = search_index(query_vector.reshape(1, -1), k)[0]
+        results = [metadata_store[i] for i in ids]
         
-        D, I = index.search(np.array([query_vector]), k)
-        results = [metadata_store[i] for i in I[0] if i < len(metadata_store)]
+        return jsonify(results)
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route("/query_batch", methods=["POST"])
+def query_batch():
+    """query equipment for several queries in one embedding call and one search"""
+    try:
+        queries = request.json.get("queries", [])
+        k = request.json.get("top_k", 50)
+        
+        if not isinstance(queries, list) or not all(isinstance(q, str) for q in queries):
+            return jsonify({"error": "queries must be a list of strings"}), 400
+        
+        if not queries:
+            return jsonify([])
+        
+        query_vectors = get_embedding_batch(queries)
+        results = [[metadata_store[i] for i in ids] for ids in search_index(query_vectors, k)]
         
         return jsonify(results)
     except Exception as e:
@@ -376,18 +823,10 @@ def query_summary():
         q = request.json.get("query")
         k = request.json.get("top_k", 50)
         
-        response = openai.embeddings.create(
-            input=[q],
-            model="text-embedding-3-small"
-        )
-        query_vector = np.array(response.data[0].embedding, dtype=np.float32)
-        
-        D, I = index.search(np.array([query_vector]), k)
+        query_vector = get_embedding_batch([q])[0]
+        ids = search_index(query_vector.reshape(1, -1), k)[0]
         
-        context = ""
-        for i in I[0]:
-            if i < len(metadata_store):
-                context += format_equipment_text(metadata_store[i]) + "\n\n"
+        context = "\n\n".join(formatted_texts[i] for i in ids)
 
         prompt = f"""
 You are an engineering assistant. Given the following equipment information:
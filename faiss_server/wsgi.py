@@ -0,0 +1,4 @@
+from faiss_server import app
+
+# the FAISS index lives in process memory, so run a single worker with threads:
+#   gunicorn -w 1 -k gthread --threads 8 wsgi:app